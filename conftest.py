@@ -0,0 +1,2 @@
+# lets a bare `pytest` run from the repo root import nv_tabular
+# without it having to be installed
@@ -1,32 +1,171 @@
+import os
+
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv
+from pyarrow import parquet as pq
+
+from . import utils
 
 
 class Dataset:
-    def __init__(self, file_name, batch_size):
-        self.df = pd.read_csv(file_name)
+    '''
+    Streams a csv or parquet file in batches of `batch_size` rows.
+    Parameters
+    ----------------------
+    file_name: str
+        Path of the file to read. Files ending in .parquet or .parq are
+        read as parquet, anything else as csv
+    batch_size: int
+        Number of rows in each batch (save for the last one)
+    block_size: int
+        Number of bytes of csv parsed at a time
+    sample_bytes: int
+        Csv column types are inferred from (roughly) this many bytes off
+        the top of the file and then pinned for the rest of it. A column
+        whose values only stop fitting the inferred type after that, like
+        an integer column with a `1.5` further down, makes reading fail
+        partway through, so either raise this or pass `column_types`
+    column_types: None or dict
+        Maps csv column names to Arrow types, overriding inference for
+        those columns
+    '''
+    def __init__(
+            self,
+            file_name,
+            batch_size,
+            block_size=1 << 20,
+            sample_bytes=16 << 20,
+            column_types=None):
+        self.file_name = file_name
         self.batch_size = batch_size
-        self.idx = 0
+        self.block_size = block_size
+        self.sample_bytes = sample_bytes
+        self.column_types = column_types
         self.workflow = None
         self.stats_context = None
+        self._apply = None
+        self._applied_state = None
+        self._num_rows = None
+        self._csv_schema = None
+
+    @property
+    def is_parquet(self):
+        return os.path.splitext(self.file_name)[1] in ('.parquet', '.parq')
+
+    @property
+    def num_rows(self):
+        if self._num_rows is None:
+            if self.is_parquet:
+                self._num_rows = pq.ParquetFile(self.file_name).metadata.num_rows
+            else:
+                # csv has no footer to read this from, so this
+                # parses the whole file once and remembers the answer
+                self._num_rows = sum(
+                    batch.num_rows for batch in self._iter_record_batches())
+        return self._num_rows
+
+    @property
+    def columns(self):
+        if self.is_parquet:
+            return pq.ParquetFile(self.file_name).schema_arrow.names
+        return self._get_csv_schema().names
 
     def __len__(self):
-        return (len(self.df) - 1) // self.batch_size + 1
+        # `list` and friends ask for `len` as a size hint before iterating,
+        # so a csv, which takes a whole parse to count, only has a length
+        # once its `num_rows` has been asked for explicitly
+        if self._num_rows is None and not self.is_parquet:
+            raise TypeError(
+                "a csv Dataset's length isn't known until its num_rows "
+                "has been read, which parses the whole file")
+        return (self.num_rows - 1) // self.batch_size + 1
 
-    def __iter__(self):
-        self.idx = 0
-        return self
+    def _get_csv_schema(self):
+        '''
+        infers the csv's column types from its first `sample_bytes`
+        bytes rather than from just the first block, which is all
+        the streaming reader would look at on its own
+        '''
+        if self._csv_schema is None:
+            reader = csv.open_csv(
+                self.file_name,
+                read_options=csv.ReadOptions(block_size=self.sample_bytes),
+                convert_options=csv.ConvertOptions(
+                    column_types=self.column_types, strings_can_be_null=True))
+            self._csv_schema = reader.schema
+            reader.close()
+        return self._csv_schema
+
+    def _iter_record_batches(self):
+        '''
+        streams arrow RecordBatches off disk without ever materializing
+        the full table. Batch sizes are dictated by the reader (row groups
+        for parquet, byte blocks for csv), not by `batch_size`
+        '''
+        if self.is_parquet:
+            return pq.ParquetFile(self.file_name).iter_batches(
+                batch_size=self.batch_size)
+        # empty fields come through as nulls, the way pandas reads them
+        return csv.open_csv(
+            self.file_name,
+            read_options=csv.ReadOptions(block_size=self.block_size),
+            convert_options=csv.ConvertOptions(
+                column_types=self._get_csv_schema(), strings_can_be_null=True))
 
-    def __next__(self):
-        if self.idx >= len(self):
-            raise StopIteration
+    def _iter_batches(self):
+        '''
+        re-chunks the reader's RecordBatches into tables of exactly
+        `batch_size` rows (save for the last one). Slicing a RecordBatch
+        is zero-copy, so this never touches the underlying buffers
+        '''
+        buffer, buffered_rows = [], 0
+        for batch in self._iter_record_batches():
+            while batch.num_rows > 0:
+                num_rows = min(self.batch_size - buffered_rows, batch.num_rows)
+                buffer.append(batch.slice(0, num_rows))
+                batch = batch.slice(num_rows)
+                buffered_rows += num_rows
 
-        x = self.df.iloc[self.idx*self.batch_size:(self.idx+1)*self.batch_size]
-        if self.workflow is not None:
-            x = self.workflow.apply(x, stats_context=self.stats_context)
+                if buffered_rows == self.batch_size:
+                    yield pa.Table.from_batches(buffer)
+                    buffer, buffered_rows = [], 0
+        if buffer:
+            yield pa.Table.from_batches(buffer)
 
-        self.idx += 1
-        return x
+    def __iter__(self):
+        # a fresh generator each time rather than the dataset itself, so
+        # iterating over the same dataset twice at once (fitting stats
+        # while writing, say) doesn't have the two share a reader
+        for table in self._iter_batches():
+            x = table.to_pandas(split_blocks=True)
+            if self.workflow is not None:
+                x = pd.DataFrame(
+                    self._get_apply()(utils.to_arrays(x)),
+                    index=x.index,
+                    copy=False)
+            yield x
+
+    def _get_apply(self):
+        '''
+        compiles the mapped workflow against the current stats. Fitting
+        a `StatsContext` always gives it a new state, so comparing states
+        by identity is enough to pick up a re-fit and recompile
+        '''
+        state = None if self.stats_context is None else self.stats_context.state
+        if self._apply is None or state is not self._applied_state:
+            self._apply = self.workflow.compile(self.stats_context)
+            self._applied_state = state
+        return self._apply
 
     def map(self, workflow, stats_context=None):
-        self.workflow = workflow
         self.stats_context = stats_context
+        self._apply, self._applied_state = None, None
+        if workflow is None:
+            self.workflow = None
+            return
+
+        # every batch has the same columns, so resolve which ones each op
+        # acts on once, here, rather than validating on every batch. The
+        # workflow is compiled against the stats lazily, see `_get_apply`
+        self.workflow = workflow.bind(self.columns)
@@ -1,9 +1,9 @@
-import six
-import re
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 
 from . import namedtuple, utils, stats
+from .utils import njit, prange
 
 
 class Op(namedtuple(
@@ -38,6 +38,10 @@ class Op(namedtuple(
         that will be the name appended with an underscore. Otherwise a callable
         will map from the original column name to the new column name
     '''
+    # no per-instance __dict__: ops are nothing but their fields, which
+    # keeps them small to build, copy via _replace and pickle
+    __slots__ = ()
+
     # override this attribute to specify the category of columns that
     # an op should apply to if specific columns aren't specified
     __default_in = utils.VariableTypes.ALL
@@ -59,40 +63,79 @@ class Op(namedtuple(
         if an explicit name was specified, use this as the _id
         Otherwise return the snake case version of the class name
         '''
-        if six.callable(self.name) or self.name is None:
+        if callable(self.name) or self.name is None:
             return utils.snake_case_class_name(self)
         return self.name
 
     def apply(self, gdf, stats_context=None, whitelist=None):
         '''
-        workhorse method responsible for applying the op's function
+        applies the op to a DataFrame. The frame is broken into a dict of
+        column arrays once up front and only rebuilt on the way out, so
+        that chains of ops (see `Workflow.apply_columnar`) never
+        round-trip through DataFrame blocks in between
+        '''
+        arrays = self.apply_columnar(
+            utils.to_arrays(gdf), stats_context, whitelist)
+        return pd.DataFrame(arrays, index=gdf.index, copy=False)
+
+    def apply_columnar(self, arrays, stats_context=None, whitelist=None):
         '''
-        columns = self._validate_columns(gdf.columns, whitelist=whitelist)
+        workhorse method responsible for applying the op's function to a
+        dict mapping column names to arrays. Returns a new dict, leaving
+        `arrays` and the arrays in it untouched
+        '''
+        columns = self._validate_columns(tuple(arrays), whitelist=whitelist)
+        if not columns:
+            return arrays.copy()
         stat_state = self._validate_stats(stats_context)
 
-        new_gdf = self._op_logic(gdf[columns], stat_state)
-  
-        if self.replace:
-            gdf[columns] = new_gdf
-        else:
-            gdf[self.get_output_names(columns)] = new_gdf
-        return gdf
+        new_arrays = self._op_logic(
+            {column: arrays[column] for column in columns}, stat_state)
+
+        arrays = arrays.copy()
+        for column in columns:
+            output_name = column if self.replace else self.map_column_name(column)
+            arrays[output_name] = new_arrays[column]
+        return arrays
+
+    def bind(self, columns):
+        '''
+        returns a copy of the op with `columns` resolved against, and
+        validated once against, the concrete columns it will be applied
+        to. Worth doing before applying an op to many batches with the same
+        columns, since otherwise a callable `columns` gets re-evaluated on
+        every column of every batch
+        '''
+        return self._replace(columns=self._validate_columns(columns))
 
     def _validate_columns(self, columns, whitelist=None):
-        if six.callable(self.columns):
-            if not any([self.columns(column) for column in columns]):
+        if callable(self.columns):
+            selected_columns = tuple(
+                column for column in columns if self.columns(column))
+            if not selected_columns:
                 raise ValueError(
                     'Op {} not set to act on any columns in {}'.format(
                         self._id, ', '.join(columns))
                 )
-            return [column for column in columns if self.columns(column)]
+            return selected_columns
 
         elif self.columns is not None:
-            missing_columns = []
-            for column in self.columns:
-                if (column not in columns and
-                    (whitelist is None or column not in whitelist)):
-                    missing_columns.append(column)
+            if not self.columns:
+                # e.g. a generic op added to a workflow with no columns
+                # of its type, so there's nothing to check
+                return ()
+
+            # check membership against sets so validating stays linear
+            # in the number of columns
+            available_columns = set(columns)
+            if whitelist is not None:
+                whitelist = set(whitelist)
+                available_columns |= whitelist
+
+            missing_columns = [
+                column for column in self.columns
+                    if column not in available_columns
+            ]
             if missing_columns:
                 raise ValueError(
                     'Op {} was called on columns {}, which does not include'
@@ -101,12 +144,12 @@ class Op(namedtuple(
                         ', '.join(columns),
                         ', '.join(missing_columns))
                 )
-            return [
-                column for column in self.columns if 
-                    whitelist is None or column not in whitelist
-            ]
+            if whitelist is None:
+                return tuple(self.columns)
+            return tuple(
+                column for column in self.columns if column not in whitelist)
         else:
-            return columns
+            return tuple(columns)
 
     def _validate_stats(self, stats_context):
         '''
@@ -151,7 +194,7 @@ class Op(namedtuple(
         returns None.
         '''
         if self.columns is not None:
-            if six.callable(self.columns):
+            if callable(self.columns):
               if not self.columns(column_name):
                   return None
             else:
@@ -160,71 +203,169 @@ class Op(namedtuple(
 
         if self.replace:
             return column_name
-        if six.callable(self.name):
+        if callable(self.name):
             return self.name(column_name)
         return '_'.join([column_name, self._id])
 
     def get_output_columns(self, columns):
-        mapped = [self.map_column_name(column) or column for column in columns]
-        if self.replace:
-            return mapped
-        else:
-            # TODO: do we need deterministic behavior here?
-            return list(set(mapped) | set(columns))
+        if self.replace or not columns:
+            # in-place ops never add or rename anything, so there's no
+            # need to map each column, and a tuple can be passed on as is
+            return tuple(columns)
+
+        # new columns get tacked on the end in order, which keeps
+        # this deterministic
+        output_columns, existing_columns = list(columns), set(columns)
+        for column in columns:
+            output_column = self.map_column_name(column)
+            if output_column is not None and output_column not in existing_columns:
+                output_columns.append(output_column)
+                existing_columns.add(output_column)
+        return tuple(output_columns)
 
     def __call__(self, workflow):
         assert isinstance(workflow, Workflow)
+        if hasattr(self, 'ops') and not self.ops:
+            # an empty workflow has nothing to validate or add
+            return workflow
         self._validate_columns(workflow.columns)
 
         if hasattr(self, 'ops'):
             # this is a workflow, so just add all the workflow's ops
             # TODO: this should check continuous and categorical separately
             if len(self.columns) == 0:
-                new_ops = [
+                new_ops = tuple(
                     op._replace(columns=workflow.get_columns(op.default_in))
                          for op in self.ops
-                ]
+                )
             else:
                 new_ops = self.ops
         elif self.columns is None:
             # this has no columns, so set columns of the appropriate
             # variable type from the workflow as the columns for a new op
             columns = workflow.get_columns(self.default_in)
-            new_ops = [self._replace(columns=columns)]
+            new_ops = (self._replace(columns=columns),)
         else:
             # this is an op and it has columns, so use it as is
             # TODO: check for callable
-            new_ops = [self]
+            new_ops = (self,)
 
         # TODO: similar checking of _id that will add a replaced version of
         # self if another op has the same _id. Maybe we do away with the
         # name callability
-        return workflow._replace(ops=workflow.ops+new_ops)
+        return workflow._add_ops(new_ops)
+
+
+class _ByIdentity(namedtuple('_ByIdentity', 'obj')):
+    '''
+    hashable wrapper which compares by identity, for caching on objects
+    like workflows which hold lists and so can't be hashed themselves.
+    Holding a reference to the wrapped object in the cache keeps its id
+    from being recycled while the entry is alive
+    '''
+    __slots__ = ()
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return self.obj is other.obj
+
+
+# resolved columns of recently used workflows, least recently used first.
+# Workflows are immutable, so an entry can only go stale if the workflow
+# changes, which makes it a different key
+_resolved_columns_cache = OrderedDict()
+_RESOLVED_COLUMNS_CACHE_SIZE = 128
+
+
+def _cache_resolved_columns(workflow, resolved_columns):
+    _resolved_columns_cache[_ByIdentity(workflow)] = resolved_columns
+    if len(_resolved_columns_cache) > _RESOLVED_COLUMNS_CACHE_SIZE:
+        _resolved_columns_cache.popitem(last=False)
 
 
 class Workflow(
         namedtuple(
             'Workflow',
             ['cat_names', 'cont_names', 'label_names', 'ops'],
-            defaults=[[], [], [], []]),
+            defaults=[(), (), (), ()]),
         Op):
-    def __new__(cls, cat_names=[], cont_names=[], label_names=[], ops=[]):
+    __slots__ = ()
+
+    def __new__(cls, cat_names=(), cont_names=(), label_names=(), ops=()):
+        # column names are kept as tuples, which can be shared between
+        # workflows and ops without anyone needing a defensive copy
         obj = cls.__bases__[0].__new__(
-            cls, cat_names, cont_names, label_names, [])
+            cls, tuple(cat_names), tuple(cont_names), tuple(label_names), ())
         for op in ops:
           obj = op(obj)
         return obj
 
-    def get_columns(self, variable_type):
-        assert hasattr(utils.VariableTypes, variable_type)
-        internal_name = re.match('C(A|ON)T', variable_type).group().lower()
-        columns = getattr(self, '{}_names'.format(internal_name))
+    @property
+    def schema(self):
+        '''
+        the workflow's input column names, keyed by variable type
+        '''
+        return {
+            utils.VariableTypes.CATEGORICAL: self.cat_names,
+            utils.VariableTypes.CONTINUOUS: self.cont_names,
+            utils.VariableTypes.LABEL: self.label_names
+        }
 
-        for op in self.ops:
-            if op.default_in.lower().startswith(variable_type):
-                columns = op.get_output_columns(columns)
+    def _resolve_columns(self, columns=None, ops=None):
+        '''
+        walks `ops` (by default all of them) once, tracking the columns of
+        each variable type coming out of each, starting from `columns` (by
+        default the workflow's schema). All of the workflow's output
+        columns are assembled at the end of the same pass under
+        `VariableTypes.ALL`. Use `_get_resolved_columns`, which caches the
+        result, rather than calling this directly
+        '''
+        columns = dict(self.schema if columns is None else columns)
+        columns.pop(utils.VariableTypes.ALL, None)
+
+        for op in self.ops if ops is None else ops:
+            if op.default_in in columns:
+                columns[op.default_in] = op.get_output_columns(
+                    columns[op.default_in])
+
+        columns[utils.VariableTypes.ALL] = sum(columns.values(), ())
         return columns
 
+    def _get_resolved_columns(self):
+        key = _ByIdentity(self)
+        try:
+            _resolved_columns_cache.move_to_end(key)
+            return _resolved_columns_cache[key]
+        except KeyError:
+            resolved_columns = self._resolve_columns()
+            _cache_resolved_columns(self, resolved_columns)
+            return resolved_columns
+
+    def _add_ops(self, ops):
+        '''
+        returns a copy of the workflow with `ops` tacked onto the end. The
+        copy's columns are resolved by picking up where this workflow's
+        left off rather than walking every op from scratch, so building up
+        a workflow one op at a time stays linear in the number of ops
+        '''
+        if not ops:
+            # e.g. applying an empty workflow
+            return self
+        workflow = self._replace(ops=self.ops + ops)
+        _cache_resolved_columns(
+            workflow, self._resolve_columns(self._get_resolved_columns(), ops))
+        return workflow
+
+    def get_columns(self, variable_type):
+        # the resolved columns have an entry for every variable type,
+        # so the lookup doubles as the check that the type exists
+        try:
+            return self._get_resolved_columns()[variable_type]
+        except KeyError:
+            raise ValueError(
+                'Unknown variable type {}'.format(variable_type))
+
     @property
     def categorical_columns(self):
         return self.get_columns(utils.VariableTypes.CATEGORICAL)
@@ -235,44 +376,204 @@ class Workflow(
 
     @property
     def columns(self):
-        return (
-            self.categorical_columns +
-            self.continuous_columns +
-            self.label_names
-        )
+        return self.get_columns(utils.VariableTypes.ALL)
 
-    def apply(self, gdf, stats_context=None):
+    def bind(self, columns):
+        '''
+        binds each op in turn to the columns coming out of the ops
+        before it, starting from `columns`
+        '''
+        ops = []
+        for op in self.ops:
+            op = op.bind(columns)
+            ops.append(op)
+            columns = op.get_output_columns(columns)
+        return self._replace(ops=tuple(ops))
+
+    def compile(self, stats_context=None):
+        '''
+        specializes the workflow to its current ops and columns and to
+        `stats_context`, returning a function which maps a dict of column
+        arrays to a new dict of transformed column arrays, like
+        `apply_columnar`. The function is generated as straight-line source
+        calling each op's `_op_logic` directly, with the op's stats looked
+        up and validated once here and bound as default arguments, so
+        there's no per-batch loop, column validation or stats lookup. Ops
+        need explicit columns, so `bind` any with callable columns first.
+        Since columns aren't validated per batch, a missing column will
+        surface as a KeyError
+        '''
+        namespace, arguments, body = {}, ['arrays'], ['    arrays = dict(arrays)']
+        for i, op in enumerate(self.ops):
+            if callable(op.columns):
+                raise ValueError(
+                    'Op {} has callable columns and must be bound to '
+                    'concrete columns before compiling'.format(op._id)
+                )
+            if not op.columns:
+                continue
+            namespace['_op_logic_{}'.format(i)] = op._op_logic
+            namespace['_stats_{}'.format(i)] = op._validate_stats(stats_context)
+            arguments.extend([
+                '_op_logic_{0}=_op_logic_{0}'.format(i),
+                '_stats_{0}=_stats_{0}'.format(i)
+            ])
+
+            inputs = ', '.join(
+                '{0!r}: arrays[{0!r}]'.format(column) for column in op.columns)
+            body.append('    new_arrays = _op_logic_{0}({{{1}}}, _stats_{0})'.format(
+                i, inputs))
+            for column in op.columns:
+                output_column = column if op.replace else op.map_column_name(column)
+                body.append('    arrays[{!r}] = new_arrays[{!r}]'.format(
+                    output_column, column))
+        body.append('    return arrays')
+
+        source = 'def _apply({}):\n{}'.format(
+            ', '.join(arguments), '\n'.join(body))
+        exec(source, namespace)
+        return namespace['_apply']
+
+    def apply_columnar(self, arrays, stats_context=None, whitelist=None):
         for op in self.ops:
-            gdf = op.apply(gdf, stats_context)
-        return gdf
+            arrays = op.apply_columnar(arrays, stats_context, whitelist)
+        return arrays
 
 
 class Log(Op):
+  __slots__ = ()
   default_in = utils.VariableTypes.CONTINUOUS
-  def _op_logic(self, gdf, stats_context=None):
-      return np.log(gdf)
+  def _op_logic(self, arrays, stats_context=None):
+      # input arrays can be read-only views on the caller's frame, so each
+      # column gets logged into one fresh array rather than in place. The
+      # ufunc casts integer inputs block by block while it goes, so that
+      # fresh array is the only allocation
+      return {column: np.log(array) for column, array in arrays.items()}
+
+
+def _center_and_scale(array, mean, inv_std, out):
+    '''
+    writes `(array - mean) * inv_std` into `out` in a single fused pass.
+    The subtraction happens at the input's precision and only the result
+    is cast to `out`'s type
+    '''
+    for i in prange(array.shape[0]):
+        out[i] = (array[i] - mean)*inv_std
+    return out
+
+
+def _numpy_center_and_scale(array, mean, inv_std, out):
+    # the subtraction is cast into `out` block by block, so
+    # numpy gets by without a full-width temporary too
+    np.subtract(array, mean, out=out, casting='unsafe')
+    out *= inv_std
+    return out
+
+
+if njit is not None:
+    _njit_center_and_scale = njit(
+        parallel=True, fastmath=True, cache=True)(_center_and_scale)
 
+    def center_and_scale(array, mean, inv_std, out):
+        # numba has no half precision, so
+        # float16 is left to numpy
+        if (
+                out.dtype not in (np.float32, np.float64) or
+                array.dtype == np.float16):
+            return _numpy_center_and_scale(array, mean, inv_std, out)
+        return _njit_center_and_scale(array, mean, inv_std, out)
+else:
+    center_and_scale = _numpy_center_and_scale
 
-class Normalize(Op):
+
+class Normalize(
+        namedtuple(
+            'Normalize',
+            ['columns', 'replace', 'name', 'dtype'],
+            defaults=[None, True, None, 'float32']),
+        Op):
+    '''
+    Centers and scales columns to zero mean and unit variance.
+    Parameters
+    ----------------------
+    dtype: str or numpy dtype
+        Float type of the normalized output. Defaults to float32, which is
+        all the precision a network consuming the output will use, and
+        halves the bytes written and moved downstream. Centering is always
+        done at double precision before casting down, so large-magnitude
+        inputs don't lose their low-order digits to the cast
+    '''
+    __slots__ = ()
     default_in = utils.VariableTypes.CONTINUOUS
     @property
     def stats_required(self):
         return [stats.Moments()]
 
-    def _op_logic(self, gdf, stats):
-        means = np.array([stats[0][column]['mean'] for column in gdf.columns])
-        vars_ = np.array([stats[0][column]['var'] for column in gdf.columns])
-        return (gdf - means) / np.sqrt(vars_)
+    def _op_logic(self, arrays, stats):
+        new_arrays = {}
+        for column, array in arrays.items():
+            moments = stats[0][column]
+            new_arrays[column] = center_and_scale(
+                array,
+                moments['mean'],
+                moments['inv_std'],
+                np.empty(array.shape, dtype=self.dtype))
+        return new_arrays
+
+
+class LogNormalize(
+        namedtuple(
+            'LogNormalize',
+            ['columns', 'replace', 'name', 'dtype'],
+            defaults=[None, True, None, 'float32']),
+        Op):
+    '''
+    Fused equivalent of a `Log` followed by a `Normalize` on the same
+    columns. Rather than materializing the logged values in between, each
+    column is logged in place in a fresh double precision copy (logged
+    timestamps and the like can have variances far below float32
+    resolution), then centered into an array of type `dtype` and scaled
+    in place. `dtype` is as in `Normalize`
+    '''
+    __slots__ = ()
+    default_in = utils.VariableTypes.CONTINUOUS
+    @property
+    def stats_required(self):
+        return [stats.LogMoments()]
+
+    def _op_logic(self, arrays, stats):
+        new_arrays = {}
+        for column, array in arrays.items():
+            moments = stats[0][column]
+            array = array.astype(np.float64)
+            np.log(array, out=array)
+
+            new_arrays[column] = center_and_scale(
+                array,
+                moments['mean'],
+                moments['inv_std'],
+                np.empty(array.shape, dtype=self.dtype))
+        return new_arrays
 
 
 class Categorify(Op):
+    __slots__ = ()
     default_in = utils.VariableTypes.CATEGORICAL
     @property
     def stats_required(self):
         return [stats.DLLabelEncoder()]
 
-    def _op_logic(self, gdf, stats):
-        new_gdf = pd.DataFrame(index=gdf.index)
-        for column in gdf.columns:
-            new_gdf[column] = stats[0][column]['encoder'].loc[gdf[column]].values
-        return new_gdf
+    def _op_logic(self, arrays, stats):
+        # the fitted dtype lists categories in code order, so these are
+        # exactly the encoder's codes, with unseen categories mapped to -1.
+        # Missing values, if any were seen while fitting, get a code of
+        # their own after all of the categories
+        new_arrays = {}
+        for column, array in arrays.items():
+            column_stats = stats[0][column]
+            codes = pd.Categorical(array, dtype=column_stats['dtype']).codes
+            if column_stats['has_null']:
+                codes = codes.copy()
+                codes[pd.isna(array)] = len(column_stats['dtype'].categories)
+            new_arrays[column] = codes
+        return new_arrays
@@ -1,7 +1,8 @@
 from . import namedtuple
-from .utils import snake_case_class_name
+from .utils import njit, snake_case_class_name, to_arrays
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 
@@ -21,50 +22,171 @@ class Stat:
     def update_value(self, state, column):
         raise NotImplementedError
 
+    def merge_state(self, state, other_state):
+        raise NotImplementedError
+
+    # override this to precompute anything derived from a column's state
+    # once fitting is done, rather than at every use of the state
+    def finalize_state(self, state):
+        return state
+
+    # override these two to give pickle a more compact representation
+    # of a column's state than the one used while fitting
+    def pack_state(self, state):
+        return state
+
+    def unpack_state(self, packed_state):
+        return packed_state
+
+
+def _merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    '''
+    Chan's parallel update, combining the (count, mean, M2) summaries of
+    two disjoint sets of values into the summary of their union
+    '''
+    count = count_a + count_b
+    if count == 0:
+        return 0, 0., 0.
+    delta = mean_b - mean_a
+    mean = mean_a + delta*(count_b/count)
+    m2 = m2_a + m2_b + delta**2 * (count_a*count_b/count)
+    return count, mean, m2
+
+
+def _welford_update(array, count, mean, m2):
+    '''
+    folds each value of `array` into a running (count, mean, M2) summary
+    in a single pass, using Welford's algorithm
+    '''
+    for x in array:
+        count += 1
+        delta = x - mean
+        mean += delta / count
+        m2 += delta*(x - mean)
+    return count, mean, m2
+
+
+if njit is not None:
+    welford_update = njit(cache=True, fastmath=True)(_welford_update)
+else:
+    # a scalar loop is hopeless in pure python, so summarize the
+    # batch with numpy instead and merge it into the running summary
+    def welford_update(array, count, mean, m2):
+        this_mean = array.mean()
+        this_m2 = np.square(array - this_mean).sum()
+        return _merge_moments(
+            count, mean, m2, array.shape[0], this_mean, this_m2)
+
 
 class Moments(Stat):
+    '''
+    running count, mean and sum of squared deviations from the mean (M2)
+    of a column. The variance is given by `m2 / count`
+    '''
     @property
     def state_values(self):
-        return ['count', 'mean', 'var']
+        return ['count', 'mean', 'm2']
 
     def initialize_state(self):
-        return {value: 0 for value in self.state_values}
+        return {'count': 0, 'mean': 0., 'm2': 0.}
+
+    def update_state(self, state, column):
+        count, mean, m2 = welford_update(
+            np.asarray(column, dtype=np.float64),
+            state['count'],
+            state['mean'],
+            state['m2'])
+        return {'count': count, 'mean': mean, 'm2': m2}
+
+    def merge_state(self, state, other_state):
+        count, mean, m2 = _merge_moments(
+            state['count'], state['mean'], state['m2'],
+            other_state['count'], other_state['mean'], other_state['m2'])
+        return {'count': count, 'mean': mean, 'm2': m2}
+
+    def finalize_state(self, state):
+        # the reciprocal standard deviation, so normalizing
+        # is a multiply with no sqrt or division per batch. A column
+        # with no spread (a constant one, or one with no rows at all)
+        # has nothing to scale away, so it just gets centered at 0
+        state = dict(state)
+        if state['m2'] > 0:
+            state['inv_std'] = np.sqrt(state['count'] / state['m2'])
+        else:
+            state['inv_std'] = 0.
+        return state
+
 
+class LogMoments(Moments):
+    '''
+    moments of the natural log of a column, for ops which log their
+    inputs before making use of the moments
+    '''
     def update_state(self, state, column):
-        old_count = state['count']
-        this_count = column.shape[0]
-        new_count = old_count + this_count
-
-        old_mean = state['mean']
-        this_mean = np.mean(column)
-        new_mean = (
-            this_mean*(this_count/new_count) +
-            old_mean*(old_count/new_count)
-        )
-
-        old_var = state['var']
-        this_var = np.var(column)
-        new_var = (
-            this_var*(this_count/new_count) +
-            old_var*(old_count/new_count) +
-            (old_count*this_count/new_count**2) * (this_mean - old_mean)**2
-        )
-        return {'count': new_count, 'mean': new_mean, 'var': new_var}
+        return super().update_state(state, np.log(column))
 
 
 class DLLabelEncoder(Stat):
+    '''
+    maps each category seen in a column to a contiguous integer code,
+    assigned in the order categories are first encountered. Missing
+    values aren't categories, they're just flagged by `has_null`
+    '''
     @property
     def state_values(self):
-        return ['encoder']
+        return ['encoder', 'has_null']
 
     def initialize_state(self):
-        return {'encoder': pd.Series()}
+        return {'encoder': {}, 'has_null': False}
 
     def update_state(self, state, column):
-        new_index = np.unique(np.concatenate([
-            state['encoder'].index, column.unique()]))
+        # grow the encoder in place rather than re-sorting and rebuilding
+        # every category seen so far on each batch. NaN never compares
+        # equal to itself, so it has to be kept out of the dict or every
+        # batch would add another one
+        encoder = state['encoder']
+        values = pd.unique(column)
+        is_null = pd.isna(values)
+        for value in values[~is_null]:
+            encoder.setdefault(value, len(encoder))
+        return {
+            'encoder': encoder,
+            'has_null': state['has_null'] or bool(is_null.any())
+        }
+
+    def merge_state(self, state, other_state):
+        encoder = state['encoder']
+        for value in other_state['encoder']:
+            encoder.setdefault(value, len(encoder))
         return {
-            'encoder': pd.Series(np.arange(len(new_index)), index=new_index)
+            'encoder': encoder,
+            'has_null': state['has_null'] or other_state['has_null']
+        }
+
+    def pack_state(self, state):
+        # codes are just insertion order, so the categories alone are
+        # enough to rebuild the encoder. For numeric categories this is a
+        # single flat buffer, which protocol 5 can hand off out-of-band
+        return pd.Index(list(state['encoder'])).to_numpy(), state['has_null']
+
+    def unpack_state(self, packed_state):
+        categories, has_null = packed_state
+        return self.finalize_state({
+            'encoder': {
+                value: code for code, value in enumerate(categories.tolist())
+            },
+            'has_null': has_null
+        })
+
+    def finalize_state(self, state):
+        # a categorical dtype whose categories are in code order, so that
+        # encoding a batch is a single hashtable pass inside pandas.
+        # Categories can't be null, which the encoder makes sure of
+        return {
+            'encoder': state['encoder'],
+            'has_null': state['has_null'],
+            'dtype': pd.CategoricalDtype(
+                categories=list(state['encoder']), ordered=False)
         }
 
 
@@ -74,7 +196,94 @@ class StatsContext(namedtuple('StatsContext', 'workflow')):
     def state(self):
         return self.__state
 
-    def fit(self, dataset, warm_start=False):
+    def _initialize_state(self):
+        state = defaultdict(list)
+        for op in self.workflow.ops:
+            for stat in op.stats_required:
+                state[op._id].append(
+                    {column: stat.initialize_state() for
+                        column in op.columns}
+                )
+        return state
+
+    def _get_fit_ops(self, state):
+        '''
+        picks out the ops that actually need to run while fitting: those
+        with stats in `state`, plus whichever ops without stats produce
+        columns that one of those consumes further down the line. Anything
+        else (e.g. a transform after the last op with stats) would just be
+        computed and thrown away on every batch. Walks the workflow
+        backwards, tracking which columns are still needed upstream
+        '''
+        needed, fit_ops = set(), []
+        for op in reversed(self.workflow.ops):
+            if op._id in state or callable(op.columns):
+                # can't tell what a callable will select ahead of
+                # time, so anything using one has to run
+                fit_ops.append(op)
+                if not callable(op.columns):
+                    needed.update(op.columns)
+                continue
+
+            output_columns = [
+                op.map_column_name(column) for column in op.columns]
+            if needed.intersection(output_columns):
+                fit_ops.append(op)
+                needed.update(op.columns)
+        return fit_ops[::-1]
+
+    def _update_state(self, state, gdf, fit_ops):
+        '''
+        folds a single batch into `state` in place, running just the
+        ops in `fit_ops`
+        '''
+        arrays = to_arrays(gdf)
+        whitelist = []
+        for op in fit_ops:
+            if op._id in state:
+                for stat, stat_state in zip(
+                      op.stats_required, state[op._id]):
+                    for column, column_state in stat_state.items():
+                      if column not in arrays:
+                          # TODO: make this more explicit
+                          raise ValueError(
+                              'Stat required for column that relied on '
+                              'stat earlier in workflow'
+                          )
+                      stat_state[column] = stat.update_state(
+                          column_state, arrays[column])
+                whitelist.extend(op.columns)
+                arrays = {
+                    column: array for column, array in arrays.items()
+                        if column not in op.columns
+                }
+            else:
+                arrays = op.apply_columnar(arrays, None, whitelist)
+
+    def _merge_state(self, state, other_state):
+        '''
+        merges `other_state`, fit on a disjoint set of batches, into
+        `state` in place
+        '''
+        for op in self.workflow.ops:
+            if op._id not in state:
+                continue
+            for stat, stat_state, other_stat_state in zip(
+                    op.stats_required, state[op._id], other_state[op._id]):
+                for column, column_state in stat_state.items():
+                    stat_state[column] = stat.merge_state(
+                        column_state, other_stat_state[column])
+
+    def fit(self, dataset, warm_start=False, num_workers=None):
+        '''
+        fits the state required by the workflow's ops to `dataset`. If
+        `num_workers` is greater than 1, batches are farmed out to a pool of
+        that many processes which each fit a partial state from scratch,
+        and partial states are merged back in in dataset order as they
+        come in. Only a bounded number of batches are in flight at once,
+        so reading the dataset overlaps with fitting it without loading
+        all of it into memory. The workflow has to be picklable for this
+        '''
         if warm_start and len(self.state) > 0:
             state = self.state.copy()
             for op in self.workflow.ops:
@@ -82,31 +291,72 @@ class StatsContext(namedtuple('StatsContext', 'workflow')):
                 for column in op.columns:
                     assert column in state[op._id]
         else:
-            state = defaultdict(list)
-            for op in self.workflow.ops:
-                for stat in op.stats_required:
-                    state[op._id].append(
-                        {column: stat.initialize_state() for
-                            column in op.columns}
-                    )
-
-        for gdf in dataset:
-            whitelist = []
-            for op in self.workflow.ops:
-                if op._id in state:
-                    for stat, stat_state in zip(
-                          op.stats_required, state[op._id]):
-                        for column, column_state in stat_state.items():
-                          if column not in gdf.columns:
-                              # TODO: make this more explicit
-                              raise ValueError(
-                                  'Stat required for column that relied on '
-                                  'stat earlier in workflow'
-                              )
-                          stat_state[column] = stat.update_state(
-                              column_state, gdf[column])
-                    whitelist.extend(op.columns)
-                    gdf = gdf.drop(columns=op.columns)
-                else:
-                    gdf = op.apply(gdf, None, whitelist)
+            state = self._initialize_state()
+
+        fit_ops = self._get_fit_ops(state)
+        if num_workers is None or num_workers <= 1:
+            for gdf in dataset:
+                self._update_state(state, gdf, fit_ops)
+        else:
+            with ProcessPoolExecutor(num_workers) as executor:
+                pending = deque()
+                for gdf in dataset:
+                    pending.append(
+                        executor.submit(
+                            _fit_batch, self.workflow, fit_ops, gdf))
+                    if len(pending) > 2*num_workers:
+                        self._merge_state(state, pending.popleft().result())
+                for future in pending:
+                    self._merge_state(state, future.result())
+
+        for op in self.workflow.ops:
+            for stat, stat_state in zip(op.stats_required, state.get(op._id, [])):
+                for column, column_state in stat_state.items():
+                    stat_state[column] = stat.finalize_state(column_state)
         self.__state = state
+
+    def __reduce__(self):
+        '''
+        pickles the state as a flat list of (op id, packed stat states)
+        pairs rather than the nested dicts used while fitting
+        '''
+        packed = []
+        for op in self.workflow.ops:
+            if op._id not in self.state:
+                continue
+            packed.append((op._id, [
+                {
+                    column: stat.pack_state(column_state)
+                        for column, column_state in stat_state.items()
+                } for stat, stat_state in zip(
+                    op.stats_required, self.state[op._id])
+            ]))
+        return (self._from_packed_state, (self.workflow, packed))
+
+    @classmethod
+    def _from_packed_state(cls, workflow, packed):
+        ops = {op._id: op for op in workflow.ops}
+        state = defaultdict(list)
+        for op_id, stat_states in packed:
+            state[op_id] = [
+                {
+                    column: stat.unpack_state(packed_state)
+                        for column, packed_state in stat_state.items()
+                } for stat, stat_state in zip(
+                    ops[op_id].stats_required, stat_states)
+            ]
+
+        obj = cls(workflow)
+        obj.__state = state
+        return obj
+
+
+def _fit_batch(workflow, fit_ops, gdf):
+    '''
+    fits a fresh state to a single batch. Lives at module level so that
+    it can be shipped to worker processes by `StatsContext.fit`
+    '''
+    stats_context = StatsContext(workflow)
+    state = stats_context._initialize_state()
+    stats_context._update_state(state, gdf, fit_ops)
+    return state
@@ -1,15 +1,36 @@
 import re
 from collections import namedtuple
+from functools import lru_cache
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range
 
 
 class VariableTypes:
     ALL = 'ALL'
     CONTINUOUS = 'CONTINUOUS'
     CATEGORICAL = 'CATEGORICAL'
+    LABEL = 'LABEL'
+
+
+@lru_cache(maxsize=None)
+def _snake_case_class(cls):
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', cls.__name__).lower()
 
 
 def snake_case_class_name(obj):
-    return re.sub(r'(?<!^)(?=[A-Z])', '_', obj.__class__.__name__).lower()
+    # memoized per class, since this sits underneath every `_id` lookup
+    return _snake_case_class(type(obj))
+
+
+def to_arrays(gdf):
+    '''
+    breaks a DataFrame into a dict mapping its column names to the
+    arrays backing each column
+    '''
+    return {column: gdf[column].to_numpy() for column in gdf.columns}
 
 
 def _namedtuple(typename, field_names, defaults=None):
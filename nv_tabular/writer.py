@@ -1,10 +1,452 @@
-from . import namedtuple
+import os
+import queue
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+from pyarrow import parquet as pq
+
+from . import ops, utils
+from .utils import njit, prange
+
+
+def _take(array, indices, out):
+    '''
+    gathers `array[indices]` into `out`, splitting the rows
+    up between threads
+    '''
+    for i in prange(indices.shape[0]):
+        out[i] = array[indices[i]]
+    return out
+
+
+if njit is not None:
+    _take = njit(parallel=True, cache=True)(_take)
+
+    def take(array, indices):
+        # numba only gets numeric columns, anything
+        # else is left to numpy's (serial) gather
+        if array.dtype.kind not in 'biuf':
+            return array[indices]
+        return _take(array, indices, np.empty(len(indices), array.dtype))
+else:
+    def take(array, indices):
+        return array[indices]
+
+
+class Writer:
+    '''
+    Writes datasets out to a single parquet file. Used as a context
+    manager, the file stays open across calls to `write`, so several
+    datasets can be written to the same file, which is finalized once on
+    the way out. Otherwise each call to `write` writes a whole file.
+    Parameters
+    ----------------------
+    write_path: str
+        Path of the parquet file to write
+    compression: str
+        Parquet compression codec. zstd at level 3 is about the best
+        tradeoff between ratio and encode speed
+    compression_level: int or None
+        Codec-specific compression level
+    row_group_bytes: int
+        Batches are buffered until they add up to at least this many
+        (uncompressed, in-memory) bytes, then written out together as one
+        row group. Lots of tiny row groups bloat the file metadata and
+        compress and scan poorly
+    num_threads: int or None
+        Number of threads used to convert each batch to Arrow, one column
+        per thread, capped at the number of columns. If left as None,
+        columns are converted one after the other. Numeric columns are
+        wrapped without a copy either way, so this only pays off for
+        columns of python objects like strings
+    max_inflight_bytes: int
+        Row groups are encoded and written on a background thread while
+        the next ones are transformed. Transforming blocks once the row
+        groups waiting to be written add up to more than this many bytes,
+        which bounds the extra memory used by writing in the background.
+        A single row group bigger than this is still let through on its own
+    write_buffer_bytes: int
+        Size of the buffer sitting between the parquet encoder and the
+        file. Encoded pages are small, so writing them straight through
+        costs a syscall apiece
+    row_group_rows: int
+        Cap on the number of rows in a row group. Batches are also written
+        out once they add up to this many rows, even if they haven't
+        reached `row_group_bytes` yet
+    data_page_size: int
+        Target (uncompressed) size of the data pages each column chunk is
+        split into. GPU readers decode pages in parallel, so a column chunk
+        should be spread over plenty of pages rather than one or two big
+        ones
+    sort_by: None or list(str)
+        Columns to sort each row group by (in ascending order) before it's
+        written. Equal values end up next to each other, so the dictionary
+        and run length encoders produce long runs, which makes for smaller
+        files that decode faster. Note that this undoes any shuffling
+        within a row group, leaving only which rows land in which row
+        group random, so it's best suited to output that gets partitioned
+        on these columns downstream anyway. Sorting happens on the
+        background writer thread
+    flush_timeout: float or None
+        If set, batches which have been buffered for at least this many
+        seconds are written out as a row group when the next batch comes
+        in, even if they haven't reached `row_group_rows` or
+        `row_group_bytes`. Keeps a slow dataset from holding everything it
+        has produced in memory, at the cost of smaller row groups
+    '''
+    def __init__(
+            self,
+            write_path,
+            compression='zstd',
+            compression_level=3,
+            row_group_bytes=128 * 2**20,
+            num_threads=None,
+            max_inflight_bytes=256 * 2**20,
+            write_buffer_bytes=2**20,
+            row_group_rows=1000000,
+            data_page_size=2**20,
+            sort_by=None,
+            flush_timeout=None):
+        self.write_path = write_path
+        self.compression = compression
+        self.compression_level = compression_level
+        self.row_group_bytes = row_group_bytes
+        self.num_threads = num_threads
+        self.max_inflight_bytes = max_inflight_bytes
+        self.write_buffer_bytes = write_buffer_bytes
+        self.row_group_rows = row_group_rows
+        self.data_page_size = data_page_size
+        self.sort_by = sort_by
+        self.flush_timeout = flush_timeout
+
+        self._entered = False
+        self._sink = None
+        self._parquet_writer = None
+        self._writer_thread = None
+        self._executor = None
+        self._held = []
+        self._held_schema = None
+        self._undictionaried_columns = set()
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_rows = 0
+        self._buffered_since = None
+
+    def __enter__(self):
+        self._entered = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._entered = False
+        self.close(flush=exc_type is None)
+
+    def _get_undictionaried_columns(self, workflow):
+        '''
+        columns which come out of a `Categorify` are already small
+        contiguous integer codes, so there's nothing to gain from running
+        them through another dictionary encoder on the way out
+        '''
+        if workflow is None:
+            return set()
+
+        columns = set()
+        for op in workflow.ops:
+            if isinstance(op, ops.Categorify) and not callable(op.columns):
+                columns.update(map(op.map_column_name, op.columns))
+        return columns
+
+    def _to_table(self, arrays):
+        '''
+        builds an Arrow table straight from a dict of column arrays.
+        Arrays are converted with pandas semantics, so NaN and None come
+        out as nulls, like they would through `Table.from_pandas`
+        '''
+        if self._executor is None:
+            columns = [_to_arrow(array) for array in arrays.values()]
+        else:
+            columns = list(self._executor.map(_to_arrow, arrays.values()))
+        return pa.Table.from_arrays(columns, names=list(arrays))
+
+    def _open(self, schema, undictionaried_columns):
+        '''
+        opens the file and starts up the threads that encode and write
+        it. Only happens once batches have come in, since the schema
+        isn't known before then (see `_hold`)
+        '''
+        self._sink = pa.output_stream(
+            self.write_path, buffer_size=self.write_buffer_bytes)
+        self._parquet_writer = pq.ParquetWriter(
+            self._sink,
+            schema,
+            compression=self.compression,
+            compression_level=self.compression_level,
+            data_page_size=self.data_page_size,
+            use_dictionary=[
+                column for column in schema.names
+                    if column not in undictionaried_columns
+            ])
+        self._writer_thread = _RowGroupWriterThread(
+            self._parquet_writer, self.max_inflight_bytes, self.sort_by)
+        self._writer_thread.start()
+
+    def _hold(self, table, undictionaried_columns):
+        '''
+        holds on to tables until the file can be opened. A column that's
+        entirely null in a batch comes out of Arrow as type `null`, which
+        nothing can be cast into, so the file isn't opened until every
+        column has turned up with a concrete type in at least one batch.
+        Until then, batches are kept in memory
+        '''
+        self._held.append(table)
+        self._undictionaried_columns = undictionaried_columns
+        if self._held_schema is None:
+            self._held_schema = table.schema
+        else:
+            self._held_schema = _fill_null_types(
+                self._held_schema, table.schema)
+        if not any(pa.types.is_null(field.type) for field in self._held_schema):
+            self._open_held()
+
+    def _open_held(self):
+        '''
+        opens the file with the types pinned down by the held tables,
+        then writes them out
+        '''
+        schema, tables = self._held_schema, self._held
+        self._held, self._held_schema = [], None
+        self._open(schema, self._undictionaried_columns)
+        for table in tables:
+            if not table.schema.equals(schema):
+                table = table.cast(schema)
+            self._put(table)
+
+    def _put(self, table):
+        '''
+        adds a table to the row group buffer, handing row groups off to
+        the writer thread as they fill up
+        '''
+        if not self._buffer:
+            self._buffered_since = time.monotonic()
+        self._buffer.append(table)
+        self._buffered_bytes += table.nbytes
+        self._buffered_rows += table.num_rows
+        while self._buffered_rows >= self.row_group_rows:
+            # split the last table so the row group comes out at
+            # exactly `row_group_rows`, carrying the rest over
+            # into the next one rather than writing a runt
+            overflow = self._buffered_rows - self.row_group_rows
+            num_rows = table.num_rows - overflow
+            self._writer_thread.put(
+                self._buffer[:-1] + [table.slice(0, num_rows)])
+            table = table.slice(num_rows)
+            self._buffer = [table] if overflow > 0 else []
+            self._buffered_bytes, self._buffered_rows = table.nbytes, overflow
+            self._buffered_since = time.monotonic()
+        if self._buffer and (
+                self._buffered_bytes >= self.row_group_bytes or (
+                    self.flush_timeout is not None and
+                    time.monotonic() - self._buffered_since >= self.flush_timeout
+                )):
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._writer_thread.put(self._buffer)
+        self._buffer, self._buffered_bytes, self._buffered_rows = [], 0, 0
 
-class Writer(namedtuple('Writer', 'write_path')):
     def write(self, dataset, workflow=None, stats_context=None, shuffler=None):
-        for gdf in dataset:
-            if workflow is not None:
-                workflow.apply(gdf, stats_context=stats_context)
-            if shuffler is not None:
-                shuffler.shuffle(gdf)
-            gdf.to_parquet(self.write_path)
+        '''
+        transforms `dataset` with `workflow` and writes it out. If given,
+        `shuffler` shuffles the rows of each batch: anything with a
+        `permutation(n)` method returning a permutation of `range(n)` (a
+        `np.random.Generator`, for instance) is used to gather all of the
+        batch's columns at once. Shufflers which only implement the older
+        in-place `shuffle(gdf)` are still supported, but deprecated
+        '''
+        undictionaried_columns = self._get_undictionaried_columns(workflow)
+
+        # the workflow is specialized to the columns of the first batch
+        # once, and its output arrays go straight to Arrow, so no
+        # intermediate DataFrame gets built for the transformed batch
+        apply = None
+
+        permute = getattr(shuffler, 'permutation', None)
+        if shuffler is not None and permute is None:
+            warnings.warn(
+                'Shufflers without a permutation method are deprecated, '
+                'implement permutation(n) rather than shuffle(gdf)',
+                DeprecationWarning)
+
+        if (
+                self._executor is None and
+                self.num_threads is not None and
+                self.num_threads > 1):
+            self._executor = ThreadPoolExecutor(self.num_threads)
+
+        succeeded = False
+        try:
+            for gdf in dataset:
+                if shuffler is not None and permute is None:
+                    shuffler.shuffle(gdf)
+
+                arrays = utils.to_arrays(gdf)
+                if workflow is not None:
+                    if apply is None:
+                        apply = workflow.bind(
+                            tuple(gdf.columns)).compile(stats_context)
+                    arrays = apply(arrays)
+                if permute is not None:
+                    indices = np.asarray(permute(len(gdf)))
+                    arrays = {
+                        column: take(array, indices)
+                            for column, array in arrays.items()
+                    }
+
+                table = self._to_table(arrays)
+                if self._parquet_writer is None:
+                    self._hold(table, undictionaried_columns)
+                    continue
+                if not table.schema.equals(self._parquet_writer.schema):
+                    table = table.cast(self._parquet_writer.schema)
+                self._put(table)
+            succeeded = True
+        finally:
+            if not self._entered:
+                self.close(flush=succeeded)
+
+    def close(self, flush=True):
+        '''
+        writes out whatever is still buffered and finalizes the file.
+        Called on the way out of a `with` block, or at the end of `write`
+        when not used as a context manager. If `flush` is False, because
+        writing failed, or if anything goes wrong while closing, the file
+        is aborted instead: everything still gets shut down, but the
+        (truncated) file is removed rather than left looking complete.
+        The writer can be used again afterwards, but will start a new file
+        '''
+        error = None
+        if flush and self._held:
+            # some column was null all the way through, so
+            # it never got a type and gets written as `null`
+            try:
+                self._open_held()
+            except Exception as e:
+                error, flush = e, False
+
+        steps = []
+        if self._writer_thread is not None:
+            if flush:
+                steps.append(self._flush)
+            steps.append(self._writer_thread.close)
+        if self._parquet_writer is not None:
+            steps.append(self._parquet_writer.close)
+        if self._sink is not None:
+            steps.append(self._sink.close)
+        if self._executor is not None:
+            steps.append(self._executor.shutdown)
+        opened = self._sink is not None
+
+        # every step gets run even if an earlier one fails, so
+        # that no thread or file handle gets left behind
+        for step in steps:
+            try:
+                step()
+            except Exception as e:
+                if error is None:
+                    error = e
+
+        self._sink, self._parquet_writer = None, None
+        self._writer_thread, self._executor = None, None
+        self._held, self._held_schema = [], None
+        self._buffer, self._buffered_bytes, self._buffered_rows = [], 0, 0
+
+        if opened and (error is not None or not flush):
+            os.remove(self.write_path)
+        if error is not None:
+            raise error
+
+
+def _fill_null_types(schema, other):
+    '''
+    `schema`, with any `null` typed fields swapped
+    for the same field in `other`
+    '''
+    return pa.schema([
+        other.field(field.name) if pa.types.is_null(field.type) else field
+            for field in schema
+    ])
+
+
+def _to_arrow(array):
+    return pa.array(array, from_pandas=True)
+
+
+class _RowGroupWriterThread(threading.Thread):
+    '''
+    consumes row groups off a bounded queue and writes them out, so that
+    encoding and IO overlap with whatever is producing the row groups.
+    `put` blocks while the row groups in flight add up to more than
+    `max_inflight_bytes`. Errors raised while writing are re-raised in the
+    producer by the next `put` or by `close`
+    '''
+    def __init__(self, parquet_writer, max_inflight_bytes, sort_by=None):
+        super().__init__(daemon=True)
+        self.parquet_writer = parquet_writer
+        self.max_inflight_bytes = max_inflight_bytes
+        self.sort_by = sort_by
+        self.inflight_bytes = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=2)
+        self._inflight_condition = threading.Condition()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, tables):
+        nbytes = sum(table.nbytes for table in tables)
+        with self._inflight_condition:
+            self._inflight_condition.wait_for(
+                lambda: (
+                    self.error is not None or
+                    self.inflight_bytes == 0 or
+                    self.inflight_bytes + nbytes <= self.max_inflight_bytes
+                )
+            )
+            self._raise_error()
+            self.inflight_bytes += nbytes
+        self._queue.put((tables, nbytes))
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            tables, nbytes = item
+            try:
+                # after an error, keep draining the queue so
+                # that the producer can't block on a full one
+                if self.error is None:
+                    _write_row_group(self.parquet_writer, tables, self.sort_by)
+            except Exception as e:
+                self.error = e
+            with self._inflight_condition:
+                self.inflight_bytes -= nbytes
+                self._inflight_condition.notify_all()
+
+    def close(self):
+        self._queue.put(None)
+        self.join()
+        self._raise_error()
+
+
+def _write_row_group(parquet_writer, tables, sort_by=None):
+    table = pa.concat_tables(tables)
+    if sort_by:
+        table = table.sort_by([(column, 'ascending') for column in sort_by])
+    parquet_writer.write_table(table, row_group_size=table.num_rows)
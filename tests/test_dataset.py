@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import nv_tabular as nvt
+
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'this_data.csv')
+
+
+def test_batches(tmp_path):
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    assert [len(gdf) for gdf in dataset] == [128]*7 + [104]
+
+
+def test_parquet_matches_csv(tmp_path):
+    path = str(tmp_path / 'data.parquet')
+    csv_dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    expected = pd.concat(list(csv_dataset), ignore_index=True)
+    expected.to_parquet(path, row_group_size=300)
+
+    parquet_dataset = nvt.dataset(path, batch_size=128)
+    assert len(parquet_dataset) == 8
+    assert [len(gdf) for gdf in parquet_dataset] == [128]*7 + [104]
+    pd.testing.assert_frame_equal(
+        pd.concat(list(parquet_dataset), ignore_index=True), expected)
+
+
+def _write_late_float_csv(path, num_rows):
+    # an integer column until the very last row
+    with open(path, 'w') as f:
+        f.write('a,b\n')
+        for i in range(num_rows):
+            f.write('{},x\n'.format(i))
+        f.write('1.5,\n')
+
+
+def test_csv_column_types_inferred_from_sample(tmp_path):
+    path = str(tmp_path / 'data.csv')
+    _write_late_float_csv(path, 2000)
+
+    # a small block size, so the float shows up many blocks in
+    dataset = nvt.dataset(path, batch_size=500, block_size=1 << 10)
+    df = pd.concat(list(dataset), ignore_index=True)
+    assert df['a'].dtype == np.float64
+    assert df['a'].iloc[-1] == 1.5
+
+
+def test_csv_column_types(tmp_path):
+    path = str(tmp_path / 'data.csv')
+    _write_late_float_csv(path, 2000)
+
+    dataset = nvt.dataset(
+        path, batch_size=500, block_size=1 << 10, sample_bytes=1 << 10)
+    with pytest.raises(pa.ArrowInvalid):
+        list(dataset)
+
+    dataset = nvt.dataset(
+        path,
+        batch_size=500,
+        block_size=1 << 10,
+        sample_bytes=1 << 10,
+        column_types={'a': pa.float64()})
+    df = pd.concat(list(dataset), ignore_index=True)
+    assert df['a'].iloc[-1] == 1.5
+
+
+def test_csv_empty_fields_are_null(tmp_path):
+    path = str(tmp_path / 'data.csv')
+    _write_late_float_csv(path, 10)
+
+    dataset = nvt.dataset(path, batch_size=500)
+    df = pd.concat(list(dataset), ignore_index=True)
+    assert df['b'].isna().tolist() == [False]*10 + [True]
+
+
+def test_map_picks_up_refit(tmp_path):
+    path = str(tmp_path / 'data.csv')
+    df = pd.read_csv(DATA_PATH)
+    df['user_age'] *= 10
+    df.to_csv(path, index=False)
+
+    workflow = nvt.ops.Workflow(
+        cont_names=['user_age'], ops=[nvt.ops.Normalize()])
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    stats_context = nvt.stats.StatsContext(workflow)
+    stats_context.fit(dataset)
+    dataset.map(workflow, stats_context)
+    before = next(iter(dataset))['user_age']
+
+    stats_context.fit(nvt.dataset(path, batch_size=128))
+    after = next(iter(dataset))['user_age']
+    assert not np.allclose(before, after)
+
+    # the stats fit on ages 10 times larger, so the
+    # normalized ages should be that much smaller
+    moments = stats_context.state['normalize'][0]['user_age']
+    ages = pd.read_csv(DATA_PATH)['user_age'].iloc[:128]
+    assert np.allclose(
+        after, (ages - moments['mean'])*moments['inv_std'], atol=1e-5)
+
+
+def test_csv_len():
+    # iterating doesn't count the rows up front
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    assert len(list(dataset)) == 8
+    assert dataset._num_rows is None
+
+    # and there's no length until they're counted explicitly
+    with pytest.raises(TypeError):
+        len(dataset)
+    assert dataset.num_rows == 1000
+    assert len(dataset) == 8
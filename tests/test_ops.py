@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import nv_tabular as nvt
+
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'this_data.csv')
+
+
+CONTINUOUS_COLUMNS = ['timestamp', 'user_age', 'item_average_rating']
+
+
+def _fit_and_apply(workflow, dataset):
+    stats_context = nvt.stats.StatsContext(workflow)
+    stats_context.fit(dataset)
+    gdf = pd.concat(list(dataset), ignore_index=True)
+    return stats_context, workflow.apply(gdf, stats_context=stats_context)
+
+
+def test_log_normalize_matches_log_then_normalize():
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    _, expected = _fit_and_apply(
+        nvt.ops.Workflow(
+            cont_names=CONTINUOUS_COLUMNS,
+            ops=[nvt.ops.Log(), nvt.ops.Normalize()]),
+        dataset)
+    stats_context, fused = _fit_and_apply(
+        nvt.ops.Workflow(
+            cont_names=CONTINUOUS_COLUMNS, ops=[nvt.ops.LogNormalize()]),
+        dataset)
+
+    df = pd.read_csv(DATA_PATH)
+    for column in CONTINUOUS_COLUMNS:
+        assert np.isclose(
+            stats_context.state['log_normalize'][0][column]['mean'],
+            np.log(df[column]).mean())
+        assert np.allclose(fused[column], expected[column], atol=1e-5)
+
+
+def test_new_columns_in_workflow_columns():
+    workflow = nvt.ops.Workflow(
+        cat_names=['a'],
+        cont_names=['b', 'c'],
+        label_names=['y'],
+        ops=[nvt.ops.Log(replace=False)])
+    assert list(workflow.continuous_columns) == ['b', 'c', 'b_log', 'c_log']
+    assert list(workflow.columns) == ['a', 'b', 'c', 'b_log', 'c_log', 'y']
+
+
+def test_categorify():
+    columns = ['uid', 'iid', 'location']
+    workflow = nvt.ops.Workflow(
+        cat_names=columns, ops=[nvt.ops.Categorify(replace=True)])
+    stats_context, encoded = _fit_and_apply(
+        workflow, nvt.dataset(DATA_PATH, batch_size=128))
+
+    df = pd.concat(
+        list(nvt.dataset(DATA_PATH, batch_size=128)), ignore_index=True)
+    for column in columns:
+        encoder = stats_context.state['categorify'][0][column]['encoder']
+        assert sorted(encoder.values()) == list(range(len(encoder)))
+        assert encoded[column].tolist() == [
+            encoder[value] for value in df[column]]
+
+
+def test_categorify_nulls(tmp_path):
+    path = str(tmp_path / 'data.parquet')
+    df = pd.read_csv(DATA_PATH)
+    df.loc[[5, 300, 900], 'location'] = None
+    df.to_parquet(path)
+
+    workflow = nvt.ops.Workflow(
+        cat_names=['location'], ops=[nvt.ops.Categorify()])
+    dataset = nvt.dataset(path, batch_size=128)
+    stats_context, encoded = _fit_and_apply(workflow, dataset)
+
+    state = stats_context.state['categorify'][0]['location']
+    assert state['has_null']
+    assert len(state['encoder']) == df['location'].nunique()
+
+    codes = encoded['location']
+    assert (codes[[5, 300, 900]] == len(state['encoder'])).all()
+    assert (codes >= 0).all()
+
+
+def test_compiled_workflow_matches_apply():
+    workflow = nvt.ops.Workflow(
+        cat_names=['uid', 'iid', 'location'],
+        cont_names=CONTINUOUS_COLUMNS,
+        ops=[nvt.ops.Categorify(), nvt.ops.Log(), nvt.ops.Normalize()])
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    stats_context = nvt.stats.StatsContext(workflow)
+    stats_context.fit(dataset)
+
+    gdf = next(iter(dataset))
+    expected = workflow.apply(gdf, stats_context=stats_context)
+    apply = workflow.bind(tuple(gdf.columns)).compile(stats_context)
+    arrays = apply(nvt.utils.to_arrays(gdf))
+    assert list(arrays) == list(expected.columns)
+    for column in expected.columns:
+        assert np.array_equal(arrays[column], expected[column].to_numpy())
+
+
+def test_center_and_scale():
+    array = np.random.default_rng(0).normal(3., 2., 1000)
+    expected = (array - 3.)*.5
+
+    # the python version of the kernel, whether or not numba is installed
+    out = nvt.ops._center_and_scale(array, 3., .5, np.empty_like(array))
+    assert np.allclose(out, expected)
+
+    out = nvt.ops.center_and_scale(
+        array, 3., .5, np.empty(len(array), dtype='float32'))
+    assert out.dtype == np.float32
+    assert np.allclose(out, expected, atol=1e-6)
+
+
+def test_empty_workflow():
+    workflow = nvt.ops.Workflow(cat_names=['a'], cont_names=['b'])
+    assert nvt.ops.Workflow()(workflow) is workflow
+
+
+def test_unknown_variable_type():
+    workflow = nvt.ops.Workflow(cat_names=['a'])
+    with pytest.raises(ValueError):
+        workflow.get_columns('NOPE')
+
+
+def test_ops_without_columns_are_skipped():
+    # no continuous columns, so Normalize has nothing to act on, and
+    # doesn't need any stats to do it
+    workflow = nvt.ops.Workflow(
+        cat_names=['a'], ops=[nvt.ops.Log(), nvt.ops.Normalize()])
+    df = pd.DataFrame({'a': [1, 2, 3]})
+    pd.testing.assert_frame_equal(workflow.apply(df), df)
+    arrays = workflow.compile()(nvt.utils.to_arrays(df))
+    assert list(arrays) == ['a']
+
+
+@pytest.mark.parametrize('op', [nvt.ops.Normalize, nvt.ops.LogNormalize])
+def test_half_precision_output(op):
+    workflow = nvt.ops.Workflow(
+        cont_names=CONTINUOUS_COLUMNS, ops=[op(dtype='float16')])
+    _, output = _fit_and_apply(
+        workflow, nvt.dataset(DATA_PATH, batch_size=128))
+    for column in CONTINUOUS_COLUMNS:
+        assert output[column].dtype == np.float16
+        assert np.isfinite(output[column]).all()
@@ -0,0 +1,165 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import nv_tabular as nvt
+
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'this_data.csv')
+
+
+CONTINUOUS_COLUMNS = ['timestamp', 'user_age', 'item_average_rating']
+
+
+def test_moments_match_numpy():
+    workflow = nvt.ops.Workflow(
+        cont_names=CONTINUOUS_COLUMNS, ops=[nvt.ops.Normalize()])
+    stats_context = nvt.stats.StatsContext(workflow)
+    stats_context.fit(nvt.dataset(DATA_PATH, batch_size=64))
+
+    df = pd.read_csv(DATA_PATH)
+    for column in CONTINUOUS_COLUMNS:
+        moments = stats_context.state['normalize'][0][column]
+        assert moments['count'] == len(df)
+        assert np.isclose(moments['mean'], df[column].mean())
+        assert np.isclose(moments['m2'] / moments['count'], df[column].var(ddof=0))
+
+
+def test_welford_update():
+    array = np.random.default_rng(0).normal(3., 2., 1000)
+    expected = (1000, array.mean(), np.square(array - array.mean()).sum())
+
+    # the python version of the kernel, whether or not numba is
+    # installed, then whichever version actually gets used
+    for update in [nvt.stats._welford_update, nvt.stats.welford_update]:
+        count, mean, m2 = update(array[:400], 0, 0., 0.)
+        count, mean, m2 = update(array[400:], count, mean, m2)
+        assert np.allclose((count, mean, m2), expected)
+
+
+def test_label_encoder_codes_in_order_seen():
+    encoder = nvt.stats.DLLabelEncoder()
+    state = encoder.initialize_state()
+    state = encoder.update_state(state, np.array(['b', 'a', 'b']))
+    state = encoder.update_state(state, np.array(['c', 'a']))
+    assert state['encoder'] == {'b': 0, 'a': 1, 'c': 2}
+
+
+def test_label_encoder_nulls():
+    encoder = nvt.stats.DLLabelEncoder()
+    state = encoder.initialize_state()
+    for _ in range(3):
+        state = encoder.update_state(state, np.array([1., np.nan, 2.]))
+    assert state['encoder'] == {1.: 0, 2.: 1}
+    assert state['has_null']
+
+    other_state = encoder.update_state(
+        encoder.initialize_state(), np.array([3., np.nan]))
+    state = encoder.merge_state(state, other_state)
+    assert state['encoder'] == {1.: 0, 2.: 1, 3.: 2}
+    assert state['has_null']
+
+
+def _get_workflow():
+    workflow = nvt.ops.Workflow(
+        cat_names=['uid', 'iid', 'location', 'has_interacted_before'],
+        cont_names=CONTINUOUS_COLUMNS,
+        label_names=['click', 'purchase'],
+        ops=[nvt.ops.Categorify(columns=['uid', 'iid', 'location'])]
+    )
+    return nvt.ops.Workflow(ops=[nvt.ops.Log(), nvt.ops.Normalize()])(workflow)
+
+
+def test_pickle_round_trip():
+    workflow = _get_workflow()
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    stats_context = nvt.stats.StatsContext(workflow)
+    stats_context.fit(dataset)
+    unpickled = pickle.loads(pickle.dumps(stats_context))
+
+    gdf = next(iter(dataset))
+    pd.testing.assert_frame_equal(
+        workflow.apply(gdf, stats_context=unpickled),
+        workflow.apply(gdf, stats_context=stats_context))
+
+
+def test_parallel_fit_matches_serial_fit():
+    workflow = _get_workflow()
+    dataset = nvt.dataset(DATA_PATH, batch_size=64)
+
+    serial = nvt.stats.StatsContext(workflow)
+    serial.fit(dataset)
+    parallel = nvt.stats.StatsContext(workflow)
+    parallel.fit(dataset, num_workers=2)
+
+    for column in ['uid', 'iid', 'location']:
+        assert (
+            serial.state['categorify'][0][column]['encoder'] ==
+            parallel.state['categorify'][0][column]['encoder']
+        )
+    for column in CONTINUOUS_COLUMNS:
+        serial_moments = serial.state['normalize'][0][column]
+        parallel_moments = parallel.state['normalize'][0][column]
+        assert serial_moments['count'] == parallel_moments['count']
+        assert np.isclose(serial_moments['mean'], parallel_moments['mean'])
+        assert np.isclose(serial_moments['m2'], parallel_moments['m2'])
+
+
+def _get_fit_op_ids(workflow):
+    stats_context = nvt.stats.StatsContext(workflow)
+    fit_ops = stats_context._get_fit_ops(stats_context._initialize_state())
+    return [op._id for op in fit_ops]
+
+
+def test_fit_ops():
+    # Log feeds Normalize, so it has to run while fitting
+    workflow = nvt.ops.Workflow(
+        cont_names=CONTINUOUS_COLUMNS, ops=[nvt.ops.Log(), nvt.ops.Normalize()])
+    assert _get_fit_op_ids(workflow) == ['log', 'normalize']
+
+    # but nothing needs a Log that comes after the last op with stats
+    workflow = nvt.ops.Workflow(
+        cont_names=CONTINUOUS_COLUMNS, ops=[nvt.ops.Normalize(), nvt.ops.Log()])
+    assert _get_fit_op_ids(workflow) == ['normalize']
+
+    # and a Log on columns that no stat uses doesn't need to run either
+    workflow = nvt.ops.Workflow(
+        cont_names=CONTINUOUS_COLUMNS,
+        ops=[
+            nvt.ops.Log(columns=['timestamp']),
+            nvt.ops.Normalize(columns=['user_age'])
+        ])
+    assert _get_fit_op_ids(workflow) == ['normalize']
+
+
+def test_constant_column(tmp_path):
+    path = str(tmp_path / 'data.csv')
+    df = pd.read_csv(DATA_PATH)
+    df['user_age'] = 30
+    df.to_csv(path, index=False)
+
+    workflow = nvt.ops.Workflow(
+        cont_names=CONTINUOUS_COLUMNS, ops=[nvt.ops.Normalize()])
+    dataset = nvt.dataset(path, batch_size=128)
+    stats_context = nvt.stats.StatsContext(workflow)
+    stats_context.fit(dataset)
+    assert stats_context.state['normalize'][0]['user_age']['inv_std'] == 0
+
+    dataset.map(workflow, stats_context)
+    output = pd.concat(list(dataset), ignore_index=True)
+    assert (output['user_age'] == 0).all()
+
+
+def test_empty_dataset(tmp_path):
+    path = str(tmp_path / 'data.csv')
+    pd.read_csv(DATA_PATH).iloc[:0].to_csv(path, index=False)
+
+    workflow = _get_workflow()
+    stats_context = nvt.stats.StatsContext(workflow)
+    stats_context.fit(nvt.dataset(path, batch_size=128))
+    for column in CONTINUOUS_COLUMNS:
+        moments = stats_context.state['normalize'][0][column]
+        assert moments['count'] == 0
+        assert moments['inv_std'] == 0
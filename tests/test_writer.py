@@ -0,0 +1,244 @@
+import os
+import threading
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from pyarrow import parquet as pq
+
+import nv_tabular as nvt
+
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'this_data.csv')
+
+
+def _row_group_sizes(path):
+    metadata = pq.ParquetFile(path).metadata
+    return [
+        metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+    ]
+
+
+def test_write_matches_dataset(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    nvt.writer.Writer(path).write(dataset)
+
+    expected = pd.concat(list(dataset), ignore_index=True)
+    pd.testing.assert_frame_equal(pd.read_parquet(path), expected)
+
+
+def test_row_group_bytes(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    nvt.writer.Writer(path).write(dataset)
+    assert _row_group_sizes(path) == [1000]
+
+    nvt.writer.Writer(path, row_group_bytes=1).write(dataset)
+    assert _row_group_sizes(path) == [128]*7 + [104]
+
+
+@pytest.mark.parametrize(
+    'row_group_bytes',
+    [
+        # lots of row groups, so the error can surface from `put`
+        1,
+        # a single row group, so the error can only surface on close
+        2**30
+    ])
+def test_writer_thread_errors(tmp_path, monkeypatch, row_group_bytes):
+    def _write_row_group(*args):
+        raise RuntimeError('failed')
+    monkeypatch.setattr(nvt.writer, '_write_row_group', _write_row_group)
+
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    num_threads = threading.active_count()
+    with pytest.raises(RuntimeError):
+        nvt.writer.Writer(path, row_group_bytes=row_group_bytes).write(dataset)
+    assert threading.active_count() == num_threads
+
+
+def test_write_workflow(tmp_path):
+    workflow = nvt.ops.Workflow(
+        cat_names=['uid', 'iid', 'location'],
+        cont_names=['timestamp', 'user_age', 'item_average_rating'],
+        label_names=['click', 'purchase'],
+        ops=[nvt.ops.Categorify(), nvt.ops.Log(), nvt.ops.Normalize()])
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    stats_context = nvt.stats.StatsContext(workflow)
+    stats_context.fit(dataset)
+
+    path = str(tmp_path / 'out.parquet')
+    nvt.writer.Writer(path).write(dataset, workflow, stats_context)
+    dataset.map(workflow, stats_context)
+    expected = pd.concat(list(dataset), ignore_index=True)
+    pd.testing.assert_frame_equal(pd.read_parquet(path), expected)
+
+
+def test_write_nulls(tmp_path):
+    df = pd.DataFrame({
+        'f': [1., np.nan, 3.],
+        's': np.array(['a', None, 'c'], dtype=object)
+    })
+    path = str(tmp_path / 'out.parquet')
+    nvt.writer.Writer(path).write([df])
+
+    table = pq.read_table(path)
+    assert table.column('f').null_count == 1
+    assert table.column('s').null_count == 1
+
+
+@pytest.mark.parametrize(
+    'row_group_rows,expected',
+    [
+        (300, [300, 300, 300, 100]),
+        (128, [128]*7 + [104]),
+        (100, [100]*10),
+        (1000000, [1000]),
+    ])
+def test_row_group_rows(tmp_path, row_group_rows, expected):
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    nvt.writer.Writer(path, row_group_rows=row_group_rows).write(dataset)
+    assert _row_group_sizes(path) == expected
+
+
+def test_shuffle(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        nvt.writer.Writer(path).write(
+            dataset, shuffler=np.random.default_rng(0))
+
+    expected = pd.concat(list(dataset), ignore_index=True)
+    written = pd.read_parquet(path)
+    assert not written['uid'].equals(expected['uid'])
+    pd.testing.assert_frame_equal(
+        written.sort_values('timestamp', kind='stable', ignore_index=True),
+        expected.sort_values('timestamp', kind='stable', ignore_index=True))
+
+
+def test_legacy_shuffler(tmp_path):
+    class _Shuffler:
+        def shuffle(self, gdf):
+            pass
+
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    with pytest.warns(DeprecationWarning):
+        nvt.writer.Writer(path).write(dataset, shuffler=_Shuffler())
+
+
+def test_sort_by(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    nvt.writer.Writer(
+        path, row_group_rows=300, sort_by=['location', 'uid']).write(dataset)
+
+    parquet_file = pq.ParquetFile(path)
+    for i in range(parquet_file.num_row_groups):
+        row_group = parquet_file.read_row_group(i).to_pandas()
+        assert row_group.equals(
+            row_group.sort_values(['location', 'uid'], ignore_index=True))
+
+
+def _slow(dataset, delay):
+    for gdf in dataset:
+        time.sleep(delay)
+        yield gdf
+
+
+def test_flush_timeout(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    nvt.writer.Writer(path, flush_timeout=.05).write(_slow(dataset, .03))
+
+    sizes = _row_group_sizes(path)
+    assert sum(sizes) == 1000
+    assert len(sizes) > 1
+
+
+def test_context_manager_appends(tmp_path):
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    with nvt.writer.Writer(path, row_group_rows=300) as writer:
+        writer.write(dataset)
+        writer.write(dataset)
+    assert _row_group_sizes(path) == [300]*6 + [200]
+
+
+@pytest.mark.parametrize('row_group_rows', [200, 1000000])
+@pytest.mark.parametrize('use_context', [False, True])
+def test_failed_writes_are_aborted(tmp_path, row_group_rows, use_context):
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    num_threads = threading.active_count()
+
+    # sorting happens on the row group thread,
+    # so a missing column fails over there
+    writer = nvt.writer.Writer(
+        path, row_group_rows=row_group_rows, sort_by=['nope'])
+    with pytest.raises(Exception):
+        if use_context:
+            with writer:
+                writer.write(dataset)
+        else:
+            writer.write(dataset)
+
+    assert threading.active_count() == num_threads
+    assert not os.path.exists(path)
+
+
+def test_dataset_errors_are_aborted(tmp_path):
+    def _failing(dataset):
+        for i, gdf in enumerate(dataset):
+            if i == 2:
+                raise RuntimeError('failed')
+            yield gdf
+
+    path = str(tmp_path / 'out.parquet')
+    dataset = nvt.dataset(DATA_PATH, batch_size=128)
+    with pytest.raises(RuntimeError):
+        nvt.writer.Writer(path).write(_failing(dataset))
+    assert not os.path.exists(path)
+
+
+def test_take():
+    rng = np.random.default_rng(0)
+    indices = rng.permutation(1000)
+    for array in [rng.normal(size=1000), np.arange(1000), np.arange(1000).astype(str)]:
+        assert np.array_equal(nvt.writer.take(array, indices), array[indices])
+
+    # the python version of the kernel, whether or not numba is installed
+    _take = getattr(nvt.writer._take, 'py_func', nvt.writer._take)
+    array = rng.normal(size=1000)
+    out = _take(array, indices, np.empty_like(array))
+    assert np.array_equal(out, array[indices])
+
+
+def test_leading_null_column(tmp_path):
+    path = str(tmp_path / 'data.parquet')
+    pd.DataFrame({
+        'a': np.arange(12),
+        's': [None]*4 + ['x', 'y']*4
+    }).to_parquet(path)
+
+    out_path = str(tmp_path / 'out.parquet')
+    nvt.writer.Writer(out_path).write(nvt.dataset(path, batch_size=4))
+    written = pd.read_parquet(out_path)
+    assert written['s'].isna().tolist() == [True]*4 + [False]*8
+    assert written['s'].iloc[4:].tolist() == ['x', 'y']*4
+
+
+def test_write_workflow_without_columns(tmp_path):
+    # any iterable of DataFrames will do, it doesn't need to be a Dataset
+    workflow = nvt.ops.Workflow(cont_names=['a'], ops=[nvt.ops.Log()])
+    gdfs = [pd.DataFrame({'a': [1., 2.]}), pd.DataFrame({'a': [3.]})]
+
+    path = str(tmp_path / 'out.parquet')
+    nvt.writer.Writer(path).write(gdfs, workflow)
+    assert np.allclose(pd.read_parquet(path)['a'], np.log([1., 2., 3.]))